@@ -1,8 +1,29 @@
+import functools
 import os
-import re
+import pwd
+import time
+
+
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def _read_mem_total():
+    """Total RAM in kB from /proc/meminfo."""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1])
+    return 0
+
+
+MEM_TOTAL = _read_mem_total()
 
 
 class ProcessState(object):
+    __slots__ = ('pid', 'user', 'pr', 'ni', 'virt', 'res', 'shr',
+                 's', 'cpu', 'mem', 'command')
+
     def __init__(self, pid, user, pr, ni, virt, res, shr,
                  s, cpu, mem, time, command):
         self.pid = int(pid)
@@ -22,47 +43,121 @@ class ProcessState(object):
         return fmt % (self.pid, self.user, self.cpu, self.mem, self.command)
 
 
+def _read_proc(path, size=8192):
+    """Read a whole /proc file with raw reads, skipping file objects.
+
+    One read is usually enough, status files with long Groups: lines (common
+    under LDAP) take more.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b''.join(chunks)
+    finally:
+        os.close(fd)
+
+
+def _snapshot_proc():
+    """Read stat and status of every process under /proc.
+
+    Returns {pid: (command, stat fields, status)}, where stat fields are the
+    fields following the command name (state is fields[0]) and status maps
+    each key of /proc/<pid>/status to its value, both left as bytes.
+    """
+    snapshot = {}
+    with os.scandir('/proc') as it:
+        for entry in it:
+            if not entry.name.isdigit():
+                continue
+            try:
+                stat = _read_proc('/proc/%s/stat' % entry.name)
+                status = _read_proc('/proc/%s/status' % entry.name)
+            except OSError:
+                # Process exited while walking
+                continue
+            # Command may contain spaces and parentheses
+            lpar, rpar = stat.find(b'('), stat.rfind(b')')
+            command = stat[lpar + 1:rpar].decode(errors='replace')
+            fields = stat[rpar + 2:].split()
+            status = dict(l.split(b':', 1) for l in status.splitlines()
+                          if b':' in l)
+            snapshot[int(entry.name)] = (command, fields, status)
+    return snapshot
+
+
+def _status_kb(status, key):
+    """Read a 'kB' value from /proc/<pid>/status, 0 if missing."""
+    value = status.get(key)
+    return int(value.split()[0]) if value else 0
+
+
 class SystemStatus(object):
+    def __init__(self, interval=1, cache_ttl=1):
+        # Seconds between the two samples used to compute %CPU
+        self.interval = interval
+        # Seconds a sample is reused by later readers of process_states
+        self.cache_ttl = cache_ttl
+        self._states = None
+        self._sampled_at = float('-inf')
+
     @property
     def system_load(self):
-        data = os.popen('uptime').read()
-        load_pat = re.compile(r'load average: (.*?), (.*?), (.*?)$')
-        return [float(x) for x in load_pat.findall(data)[0]]
+        with open('/proc/loadavg') as f:
+            load_1m, load_5m, load_15m, *_ = f.read().split()
+        return [float(load_1m), float(load_5m), float(load_15m)]
 
     @property
     def process_states(self):
-        data = os.popen(
-            'top -b -u \'!root\' -d .1 -n 10').read()
-        pat = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]|\x1b\(B|\x1b>')
-        data = pat.sub('', data)
-        data = data[data.rfind('top - '):].split('\n')[7:-1]
-        states = [ProcessState(*x.split(maxsplit=11)) for x in data]
-        data = os.popen('ps axo pid,user:20').read().split('\n')[1:-1]
-        pid_to_user = dict(x.strip().split(maxsplit=1) for x in data)
-
-        def valid_process_state(state):
-            if str(state.pid) not in pid_to_user:
-                return False
-            return True
-
-        states = [state for state in states if valid_process_state(state)]
-        for state in states:
-            state.user = pid_to_user[str(state.pid)]
+        if time.monotonic() - self._sampled_at < self.cache_ttl:
+            return self._states
+        before = _snapshot_proc()
+        t1 = time.monotonic()
+        time.sleep(self.interval)
+        after = _snapshot_proc()
+        t2 = time.monotonic()
+        elapsed = (t2 - t1) * CLK_TCK
+        uid_to_user = {}
+        states = []
+        for pid, (command, fields, status) in after.items():
+            uid = int(status[b'Uid'].split()[1])
+            if uid == 0:
+                continue
+            if uid not in uid_to_user:
+                try:
+                    uid_to_user[uid] = pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    uid_to_user[uid] = str(uid)
+            ticks = int(fields[11]) + int(fields[12])
+            prev = before.get(pid)
+            # Treat reused pids and newly started processes as new
+            if prev is not None and prev[1][19] == fields[19]:
+                prev_ticks = int(prev[1][11]) + int(prev[1][12])
+            else:
+                prev_ticks = 0
+            cpu = 100 * (ticks - prev_ticks) / elapsed
+            res = int(fields[21]) * PAGE_SIZE // 1024
+            mem = 100 * res / MEM_TOTAL if MEM_TOTAL else 0
+            shr = (_status_kb(status, b'RssFile') +
+                   _status_kb(status, b'RssShmem'))
+            states.append(ProcessState(
+                pid, uid_to_user[uid], fields[15].decode(),
+                fields[16].decode(), int(fields[20]) // 1024, res, shr,
+                fields[0].decode(), cpu, mem, ticks / CLK_TCK, command))
+        self._states, self._sampled_at = states, t2
         return states
 
-    @property
-    def _process_states(self):
-        data = os.popen(
-            'ps axo pid,user:20,pri,ni,vsz,rss,pcpu,pmem,comm').read()
-        data = data.split('\n')[1:-1]
-        return [ProcessState(*x.split(maxsplit=8)) for x in data]
-
 
 system_status = SystemStatus()
 
 
+@functools.lru_cache(maxsize=4096)
 def get_uid(username):
-    return int(os.popen('id -u %s' % username).read())
+    return pwd.getpwnam(username).pw_uid
 
 
 if __name__ == '__main__':
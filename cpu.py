@@ -3,7 +3,7 @@ import logging
 import os
 import signal
 import sys
-import time
+import threading
 
 from collections import defaultdict
 
@@ -16,7 +16,6 @@ from config import config
 class PriorityScheduler(Daemon):
     """Update processes priority dynamically."""
     ss = system_status
-    __exit_now = False
     __exited = False
 
     def __init__(self):
@@ -27,34 +26,53 @@ class PriorityScheduler(Daemon):
         self.ram_intervene = config.getint('cpu', 'ram_intervene')
         self.interval = config.getint('cpu', 'interval')
         self.excluded_users = config['cpu']['excluded'].split(',')
+        self._users_cache = (None, frozenset())
         scheduler = config['cpu']['scheduler']
         self.scheduler = getattr(self, scheduler, None)
         if self.scheduler is None:
             logging.critical('No such scheduler')
             raise AttributeError('No such scheduler')
+        self.__exit_now = threading.Event()
         signal.signal(signal.SIGTERM, self.__exit)
+        signal.signal(signal.SIGHUP, self.__reload)
 
     def __exit(self, *args, **kwargs):
         """SIGTERM handler."""
-        if self.__exit_now:
+        if self.__exit_now.is_set():
             return
         logging.info('>>> PriorityScheduler <<< deactivating')
-        self.__exit_now = True
+        self.__exit_now.set()
+
+    def __reload(self, *args, **kwargs):
+        """SIGHUP handler."""
+        logging.info('Reloading user database')
+        get_uid.cache_clear()
+
+    def _valid_users(self):
+        """Users with a home directory, cached until /home changes."""
+        mtime = os.stat('/home').st_mtime_ns
+        if mtime != self._users_cache[0]:
+            self._users_cache = (mtime, frozenset(os.listdir('/home')))
+        return self._users_cache[1]
 
     def load_stats(self):
         """Load process status from SystemStatus."""
         logging.debug('Load stats')
         process_states = self.ss.process_states
-        valid_users = os.listdir('/home')
+        valid_users = self._valid_users()
         processes = defaultdict(list)
         user_processes_cnt = defaultdict(int)
+        user_cpu = defaultdict(float)
+        user_ram = defaultdict(float)
         for ps in process_states:
             if ps.user in valid_users:
                 if ps.user in self.excluded_users:
                     continue
                 processes[ps.user].append(ps)
                 user_processes_cnt[ps.user] += 1
-        return processes, user_processes_cnt
+                user_cpu[ps.user] += ps.cpu
+                user_ram[ps.user] += ps.mem
+        return processes, user_processes_cnt, user_cpu, user_ram
 
     def user_cpu_fair_scheduler(self, *stats):
         """Fair scheduler for users.
@@ -62,20 +80,29 @@ class PriorityScheduler(Daemon):
         Guarantee that each user will have fair CPU computing power.
         """
         logging.debug('User cpu fair scheduler called')
-        processes, cnts, *_ = stats
+        processes, cnts, user_cpu, *_ = stats
+        if not cnts:
+            return
         min_user_processes = min(cnts.values())
-        priorities = {}
+        # Pids grouped by unscaled priority, most processes share a value
+        priorities = defaultdict(list)
         for user, user_processes in cnts.items():
             user_ni = user_processes / min_user_processes
-            total_process_weight = sum(p.cpu for p in processes[user])
+            total_process_weight = user_cpu[user]
             for p in processes[user]:
+                # Idle processes do not compete for CPU
+                if not p.cpu:
+                    continue
                 process_ni = round_by(total_process_weight / p.cpu, 100) or 1
-                priorities[p.pid] = process_ni * user_ni
-        rescaler = build_rescaler(1, max(priorities.values()), 0, 19)
-        priorities = {pid: round(rescaler(pri))
-                      for pid, pri in priorities.items()}
-        for pid, pri in priorities.items():
-            self.__renice(pid=pid, pri=pri)
+                priorities[process_ni * user_ni].append(p.pid)
+        if not priorities:
+            return
+        rescaler = build_rescaler(1, max(priorities), 0, 19)
+        buckets = defaultdict(list)
+        for pri, pids in priorities.items():
+            buckets[round(rescaler(pri))].extend(pids)
+        for pri, pids in buckets.items():
+            self.__renice(pids=pids, pri=pri)
 
     def user_ram_penalty_scheduler(self, *stats):
         """Penalty scheduler for RAM.
@@ -84,11 +111,7 @@ class PriorityScheduler(Daemon):
         by renice process to 19(lowest priority).
         """
         logging.debug('User ram penalty scheduler called')
-        processes, *_ = stats
-        user_ram = defaultdict(float)
-        for user, user_processes in processes.items():
-            for p in user_processes:
-                user_ram[user] += p.mem
+        _, _, _, user_ram, *_ = stats
         for user, ram in user_ram.items():
             if ram > self.ram_intervene:
                 uid = get_uid(user)
@@ -101,25 +124,29 @@ class PriorityScheduler(Daemon):
         self.user_ram_penalty_scheduler(*stats)
 
     @staticmethod
-    def __renice(pid=None, uid=None, pri=0):
-        """Renice by pid or uid."""
-        if not pid and not uid:
-            raise ValueError('Must provide pid or uid')
-        elif pid:
-            cmd = 'renice -n %d -p %d' % (pri, pid)
+    def __renice(pids=None, uid=None, pri=0):
+        """Renice by pids or uid."""
+        if not pids and not uid:
+            raise ValueError('Must provide pids or uid')
+        elif pids:
+            which, whos = os.PRIO_PROCESS, pids
         else:
-            cmd = 'renice -n %d -u %d' % (pri, uid)
-        logging.debug(cmd)
-        os.popen(cmd)
+            which, whos = os.PRIO_USER, [uid]
+        for who in whos:
+            try:
+                os.setpriority(which, who, pri)
+            except (ProcessLookupError, PermissionError) as e:
+                # Process exited or is not ours to renice
+                logging.debug('Renice %d failed: %s' % (who, e))
 
     def none_scheduler(self, *stats):
         """Reset all niceness to 0."""
         logging.debug('None scheduler called')
         processes, *_ = stats
-        for user, processes in processes.items():
-            for process in processes:
-                pid = process.pid
-                self.__renice(pid=pid)
+        pids = [p.pid for user_processes in processes.values()
+                for p in user_processes]
+        if pids:
+            self.__renice(pids=pids)
 
     def run(self):
         """Scheduler core."""
@@ -139,10 +166,8 @@ class PriorityScheduler(Daemon):
                     self.scheduler(*stats)
                     msg = '<%s> finished, go to sleep.' % scheduler_name
                     logging.info(msg)
-                for _ in range(int(self.interval)):
-                    if self.__exit_now:
-                        return
-                    time.sleep(1)
+                if self.__exit_now.wait(self.interval):
+                    return
         except Exception as e:
             logging.error(e)
         finally:
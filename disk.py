@@ -4,9 +4,11 @@ import os.path as osp
 import re
 import signal
 import sys
-import time
+import threading
 import logging
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
 
@@ -18,7 +20,6 @@ from config import config
 class DiskUsageMonitor(Daemon):
     """Monitor disk usage and respond."""
     ss = system_status
-    __exit_now = False
     __exited = False
 
     def __init__(self):
@@ -35,15 +36,17 @@ class DiskUsageMonitor(Daemon):
         self.quota_bytes = quota_bytes
         self._quota = user_quota
         self.interval = config.getint('disk', 'interval')
+        self.scan_workers = config.getint('disk', 'scan_workers', fallback=16)
         self.excluded_users = config['cpu']['excluded'].split(',')
+        self.__exit_now = threading.Event()
         signal.signal(signal.SIGTERM, self.__exit)
 
     def __exit(self, *args, **kwargs):
         """SIGTERM handler."""
-        if self.__exit_now:
+        if self.__exit_now.is_set():
             return
         logging.info('>>> DiskUsageMonitor <<< deactivating')
-        self.__exit_now = True
+        self.__exit_now.set()
 
     @staticmethod
     def is_critical_process(p):
@@ -56,36 +59,77 @@ class DiskUsageMonitor(Daemon):
 
     @staticmethod
     def __kill_process(pid):
-        """Kill process."""
-        cmd = 'kill -9 %d' % pid
-        logging.debug(cmd)
-        os.popen(cmd)
+        """Kill process, return whether it was still running."""
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Process already exited
+            return False
+        return True
+
+    @staticmethod
+    def _du(path):
+        """Disk usage of path in 1K blocks, like `du -s`."""
+        st = os.lstat(path)
+        seen = {(st.st_dev, st.st_ino)}
+        blocks = st.st_blocks
+        stack = [path]
+        while stack:
+            try:
+                it = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    # Count hard links only once
+                    if st.st_nlink > 1:
+                        key = (st.st_dev, st.st_ino)
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    blocks += st.st_blocks
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        # st_blocks is in 512-byte units
+        return (blocks + 1) // 2
 
     def kill_quota_exceeded_processes(self, disk_usage):
         """Kill all processes belong to quota-exceeded users."""
         logging.debug('Kill processes')
-        for user, usage in disk_usage.items():
-            if usage <= self.quota_bytes:
-                continue
+        exceeded = [user for user, usage in disk_usage.items()
+                    if usage > self.quota_bytes]
+        if not exceeded:
+            return
+        processes = defaultdict(list)
+        for p in self.ss.process_states:
+            processes[p.user].append(p)
+        for user in exceeded:
             logging.info('Quota exceeded User: %s' % user)
-            processes = (p for p in self.ss.process_states
-                         if p.user == user and not self.is_critical_process(p))
-            for p in processes:
-                self.__kill_process(p.pid)
+            killed = [p.pid for p in processes.get(user, ())
+                      if not self.is_critical_process(p) and
+                      self.__kill_process(p.pid)]
+            if killed:
+                logging.info('Killed processes of %s: %s' % (
+                    user, ' '.join(str(pid) for pid in killed)))
 
     def load_usage(self):
         """Load disk usage."""
         logging.debug('Load usage')
         base_dir = '/home'
-        disk_usage = {}
-        for user_name in os.listdir(base_dir):
-            if user_name.startswith('.') or user_name in self.excluded_users:
-                continue
-            path = osp.join(base_dir, user_name)
-            usage, _ = os.popen('du -s %s' % path).read().split()
-            usage = int(usage)
-            disk_usage[user_name] = usage
-        return disk_usage
+        users = [user_name for user_name in os.listdir(base_dir)
+                 if not user_name.startswith('.') and
+                 user_name not in self.excluded_users]
+        if not users:
+            return {}
+        paths = [osp.join(base_dir, user_name) for user_name in users]
+        # Walking is syscall-bound, so threads overlap it despite the GIL
+        workers = min(self.scan_workers, len(users))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(users, executor.map(self._du, paths)))
 
     def run(self):
         """Monitor core."""
@@ -98,10 +142,8 @@ class DiskUsageMonitor(Daemon):
                 self.kill_quota_exceeded_processes(disk_usage)
                 msg = 'Disk check finished, go to sleep.'
                 logging.info(msg)
-                for _ in range(int(self.interval)):
-                    if self.__exit_now:
-                        return
-                    time.sleep(1)
+                if self.__exit_now.wait(self.interval):
+                    return
         except Exception as e:
             logging.error(e)
         finally:
@@ -1,12 +1,18 @@
 import argparse
+import atexit
+import contextlib
+import fcntl
+import hashlib
 import logging
 import os
-import os.path as osp
+import subprocess
 import sys
+import threading
 import time
 import re
 
-from flask import Flask, request
+from flask import Flask, Response, request
+from gunicorn.app.base import BaseApplication
 
 import utils
 
@@ -14,76 +20,166 @@ from core.daemon import Daemon
 from config import config
 
 
+log = logging.getLogger(__name__)
+
 app = Flask(__name__)
 
+_USERNAME_RE = re.compile(r'[A-Za-z0-9]+')
+
+
+class _FileDictCache(object):
+    """Parsed `key value` files, re-read only when they change on disk.
+
+    Entries are keyed by path and hold ((st_mtime_ns, st_size), dict). Size is
+    part of the key so appends landing within one mtime tick are still seen.
+    Files appended to are kept open, line buffered, until close() or reopen(),
+    and are reopened when the path no longer refers to the open file.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._handles = {}
+        self._reopen = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _version(st):
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, path):
+        """Return the parsed file, {} if it does not exist."""
+        with self._lock:
+            try:
+                version = self._version(os.stat(path))
+            except FileNotFoundError:
+                self._entries.pop(path, None)
+                return {}
+            entry = self._entries.get(path)
+            if entry is None or entry[0] != version:
+                entry = (version, utils.load_two_col(path))
+                self._entries[path] = entry
+            return entry[1]
+
+    def append(self, path, key, value):
+        """Append `key value` to path, the next get() re-reads it."""
+        with self._lock:
+            if self._reopen:
+                self._close_handles()
+                self._reopen = False
+            f = self._handles.get(path)
+            if f is not None and not self._is_current(f, path):
+                # Replaced (e.g. edited with vim or sed -i) or removed
+                f.close()
+                f = None
+            if f is None:
+                f = self._handles[path] = open(path, 'a', buffering=1)
+            f.write('%s %s\n' % (key, value))
+            f.flush()
+            # Other workers may have appended too, so do not patch in place
+            self._entries.pop(path, None)
+
+    @staticmethod
+    def _is_current(f, path):
+        """Whether the open file f is still the file at path."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return False
+        fst = os.fstat(f.fileno())
+        return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+    def reopen(self):
+        """Reopen appended files on next use, e.g. in a forked worker."""
+        self._reopen = True
+
+    def close(self):
+        """Close files kept open for appending."""
+        with self._lock:
+            self._close_handles()
+
+    def _close_handles(self):
+        for f in self._handles.values():
+            f.close()
+        self._handles.clear()
+
+
+_file_cache = _FileDictCache()
+atexit.register(_file_cache.close)
+
 
 def read_processed_users():
-    processed_users_file = config['users']['processed_users_file']
-    if not osp.exists(processed_users_file):
-        return {}
-    with open(processed_users_file) as f:
-        processed = dict([l.strip().split() for l in f])
-    return processed
+    return _file_cache.get(config['users']['processed_users_file'])
+
+
+@contextlib.contextmanager
+def processed_users_lock():
+    """Exclusive flock on the processed users file, across all workers."""
+    with open(config['users']['processed_users_file'], 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def write_processed(student_id, username):
     processed_users_file = config['users']['processed_users_file']
-    with open(processed_users_file, 'a') as f:
-        msg = '%s %s' % (student_id, username)
-        f.write(msg + '\n')
-    logging.info('Registration succeed: ' + msg)
+    _file_cache.append(processed_users_file, student_id, username)
+    log.info('Registration succeed: %s %s', student_id, username)
 
 
 def read_users():
-    users_file = config['users']['users_file']
-    if not osp.exists(users_file):
-        return {}
-    with open(users_file) as f:
-        users = dict([l.strip().split() for l in f])
-    return users
+    return _file_cache.get(config['users']['users_file'])
 
 
 @app.route('/register', methods=['POST'])
 def register():
-    processed_users = read_processed_users()
-    users = read_users()
     username = request.form['username'] or request.form['student_id']
     password = request.form['password']
     confirm_password = request.form['confirm_password']
     student_id = request.form['student_id']
     student_name = request.form['student_name']
     msg = ''
-    if not username or re.sub(r'^[a-zA-Z0-9]+$', '', username) != '':
+    if not username or not _USERNAME_RE.fullmatch(username):
         msg = '用户名包含非法字符!'
     elif password != confirm_password:
         msg = '密码前后不一致!'
-    elif student_id not in users:
-        msg = '学号不在受邀注册范围内!'
-    elif student_id in processed_users:
-        msg = '学号已被注册!'
-    elif student_name != users[student_id]:
-        msg = '学号姓名不匹配!'
+    elif '\n' in password or '\r' in password:
+        # chpasswd reads one user:password pair per line
+        msg = '密码包含非法字符!'
     if msg:
-        logging.info(
-            'Registration failed: ' + msg + '(%s)' % str(request.form))
+        log.info('Registration failed: %s (student_id=%s, username=%s)',
+                 msg, student_id, username)
         return msg
-    try:
-        p = os.popen('useradd -m %s -s /bin/bash' % username)
-        if p.close() is not None:
-            raise Exception()
-        p = os.popen('echo "%s:%s" | chpasswd' % (username, password))
-        if p.close() is not None:
-            raise Exception()
-        write_processed(student_id, username)
-    except Exception as e:
-        return '注册失败,请重试!(若重复出现，请联系系统管理员)'
-    else:
-        return '注册成功!'
+    # Held from the duplicate check through the append, so two workers cannot
+    # register the same student_id
+    with processed_users_lock():
+        users = read_users()
+        processed_users = read_processed_users()
+        if student_id not in users:
+            msg = '学号不在受邀注册范围内!'
+        elif student_id in processed_users:
+            msg = '学号已被注册!'
+        elif student_name != users[student_id]:
+            msg = '学号姓名不匹配!'
+        if msg:
+            log.info('Registration failed: %s (student_id=%s, username=%s)',
+                     msg, student_id, username)
+            return msg
+        try:
+            subprocess.run(['useradd', '-m', username, '-s', '/bin/bash'],
+                           check=True)
+            subprocess.run(['chpasswd'],
+                           input=('%s:%s\n' % (username, password)).encode(),
+                           check=True)
+            write_processed(student_id, username)
+        except (OSError, subprocess.CalledProcessError) as e:
+            return '注册失败,请重试!(若重复出现，请联系系统管理员)'
+        else:
+            return '注册成功!'
 
 
-@app.route('/')
-def register_form():
-    return '''
+_FORM_BYTES = '''
 <script>
 function check_input()
 {
@@ -125,7 +221,32 @@ function check_input()
     </p>
     </form>
 </div>
-'''
+'''.encode('utf-8')
+_FORM_ETAG = hashlib.blake2b(_FORM_BYTES, digest_size=16).hexdigest()
+
+
+@app.route('/')
+def register_form():
+    response = Response(_FORM_BYTES, mimetype='text/html',
+                        headers={'Cache-Control': 'public, max-age=3600'})
+    response.set_etag(_FORM_ETAG)
+    return response.make_conditional(request)
+
+
+class _GunicornApplication(BaseApplication):
+    """Embedded gunicorn server for a WSGI application."""
+
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super(_GunicornApplication, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
 
 
 class UserRegistration(Daemon):
@@ -133,8 +254,22 @@ class UserRegistration(Daemon):
         pidfile = config['users']['pidfile']
         super(UserRegistration, self).__init__(pidfile)
 
+    def post_fork(self, server, worker):
+        """Gunicorn post_fork hook, run in each new worker."""
+        # The pidfile belongs to the master, do not remove it on worker exit
+        atexit.unregister(self.delpid)
+        _file_cache.reopen()
+
     def run(self):
-        app.run('0.0.0.0')
+        """Serve with gunicorn, SIGHUP to the master recycles workers."""
+        options = {
+            'bind': config.get('users', 'bind', fallback='0.0.0.0:5000'),
+            'workers': config.getint('users', 'workers', fallback=4),
+            'worker_class': 'gthread',
+            'threads': config.getint('users', 'threads', fallback=4),
+            'post_fork': self.post_fork,
+        }
+        _GunicornApplication(app, options).run()
 
 
 def main():
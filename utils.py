@@ -1,22 +1,55 @@
 """Userful tools for SIE Server Admin."""
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
 
 from config import config
 
 
-logging.basicConfig(
-    filename=config['logging']['logfile'],
-    format=config['logging']['logfmt'],
-    datefmt=config['logging']['datefmt'],
-    level=logging.INFO)
+# Records are queued by the calling thread and written by a listener thread,
+# the log file itself is only opened by the listener on first write.
+_file_handler = logging.FileHandler(config['logging']['logfile'], delay=True)
+_file_handler.setFormatter(logging.Formatter(
+    fmt=config['logging']['logfmt'],
+    datefmt=config['logging']['datefmt']))
+_queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+# Only merge args into the message, _file_handler applies logfmt
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+_log_listener = None
+
+
+def _start_log_listener():
+    """Start a listener writing queued records to the log file."""
+    global _log_listener
+    # A fresh queue, records left from before a fork belong to the parent
+    _queue_handler.queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(
+        _queue_handler.queue, _file_handler, respect_handler_level=True)
+    _log_listener.start()
+
+
+def _stop_log_listener():
+    """Flush queued records and stop the listener."""
+    _log_listener.stop()
+
+
+logging.basicConfig(handlers=[_queue_handler], level=logging.INFO)
+_start_log_listener()
+atexit.register(_stop_log_listener)
+# Threads do not survive fork, so daemonized processes and gunicorn workers
+# need a listener of their own
+os.register_at_fork(after_in_child=_start_log_listener)
 
 
 def build_rescaler(src_min, src_max, tar_min, tar_max):
     """Build a rescaler to rescale [src_min, src_max] -> [tar_min, tar_max]."""
+    if src_min == src_max:
+        return lambda x: 0
+    tar_ratio = (tar_max - tar_min) / (src_max - src_min)
+
     def _wrapped(x):
-        if src_min == src_max:
-            return 0
-        tar_ratio = (tar_max - tar_min) / (src_max - src_min)
         return tar_ratio * (x - src_min) + tar_min
     return _wrapped
 
@@ -24,6 +57,8 @@ def build_rescaler(src_min, src_max, tar_min, tar_max):
 def round_by(x, round_step):
     """Round a value to nearest k * round_step.
 
+    Array-likes are rounded elementwise with NumPy.
+
     Examples:
     ---------
     >>> round_by(165, 50)
@@ -31,4 +66,19 @@ def round_by(x, round_step):
     >>> round_by(175, 50)
     200
     """
+    if hasattr(x, '__array__'):
+        import numpy as np
+        return np.round(np.asarray(x) / round_step) * round_step
     return round(x / round_step) * round_step
+
+
+def load_two_col(path):
+    """Load a whitespace separated `key value` file into a dict.
+
+    Blank lines are skipped, a missing file gives {}.
+    """
+    try:
+        with open(path) as f:
+            return dict(line.split() for line in f if not line.isspace())
+    except FileNotFoundError:
+        return {}